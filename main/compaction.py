@@ -0,0 +1,196 @@
+import os
+import time
+import uuid
+import logging
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from utils import parquet_write_options
+
+log = logging.getLogger("main")
+
+
+def list_data_files(path):
+    """Return the parquet data files of a dataset directory, skipping hidden and summary files (starting with . or _)"""
+    data_files = []
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if not d.startswith((".", "_"))]
+        for file_name in files:
+            if file_name.endswith(".parquet") and not file_name.startswith((".", "_")):
+                data_files.append(os.path.join(root, file_name))
+    return sorted(data_files)
+
+
+def run_basename(marker=None):
+    """File name template for the files of one write of a dataset: <marker>-<guid>-{i}.parquet.
+    The marker (time.time_ns() by default) orders the runs, the guid keeps the names of runs unique
+    """
+    marker = time.time_ns() if marker is None else marker
+    return f"{marker}-{uuid.uuid4().hex}-{{i}}.parquet"
+
+
+def get_run_id(file_path):
+    """Return the <marker>-<guid> part of a file name written with run_basename, or the <guid> part of
+    the default pyarrow file names (<guid>-<i>.parquet), that identifies the run that wrote the file
+    """
+    parts = os.path.basename(file_path).split("-")
+    if parts[0].isdigit():
+        return f"{parts[0]}-{parts[1]}"
+    return parts[0]
+
+
+def get_run_order(file_path):
+    """Sort key of the run of a file: the run marker of the file name, files without a marker are older
+    than any marked run, and only they are ordered by modification time"""
+    run_id = get_run_id(file_path)
+    if run_id.split("-")[0].isdigit():
+        return (int(run_id.split("-")[0]), 0)
+    return (-1, os.stat(file_path).st_mtime_ns)
+
+
+def find_superseded_files(data_files):
+    """Split the files to the ones written by the latest run and the ones superseded by it"""
+    run_orders = {}
+    for file_path in data_files:
+        run_id = get_run_id(file_path)
+        run_orders[run_id] = max(
+            run_orders.get(run_id, (-1, 0)), get_run_order(file_path)
+        )
+    if not run_orders:
+        return [], []
+    latest_run = max(run_orders, key=run_orders.get)
+    current = [f for f in data_files if get_run_id(f) == latest_run]
+    superseded = [f for f in data_files if get_run_id(f) != latest_run]
+    return current, superseded
+
+
+def plan_compaction(data_files, target_size):
+    """Group the small files of each partition directory into bins of up to target_size bytes,
+    only bins with more than one file need to be merged"""
+    partitions = {}
+    for file_path in data_files:
+        partitions.setdefault(os.path.dirname(file_path), []).append(file_path)
+    bins = []
+    for files in partitions.values():
+        small_files = sorted(
+            (f for f in files if os.path.getsize(f) < target_size),
+            key=os.path.getsize,
+        )
+        current_bin, current_size = [], 0
+        for file_path in small_files:
+            file_size = os.path.getsize(file_path)
+            if current_bin and current_size + file_size > target_size:
+                bins.append(current_bin)
+                current_bin, current_size = [], 0
+            current_bin.append(file_path)
+            current_size += file_size
+        bins.append(current_bin)
+    return [files for files in bins if len(files) > 1]
+
+
+def merge_files(files, profile=None):
+    """Merge the files of one partition into a single file, which is first written under a hidden name
+    and then renamed, so readers never see a half written file"""
+    directory = os.path.dirname(files[0])
+    file_name = f"{get_run_id(files[0])}-compacted-{uuid.uuid4().hex}.parquet"
+    temp_path = os.path.join(directory, f".{file_name}")
+    table = pa.concat_tables([pq.read_table(file_path) for file_path in files])
+    options = parquet_write_options(profile, table.column_names)
+    options.pop("index", None)
+    pq.write_table(table, temp_path, **options)
+    os.replace(temp_path, os.path.join(directory, file_name))
+    return os.path.join(directory, file_name)
+
+
+def write_metadata_files(path, data_files):
+    """Write the _metadata (row groups of every file) and _common_metadata (schema) summary files,
+    so readers can plan the scan without listing the partition directories"""
+    if not data_files:
+        return
+    metadata = None
+    for file_path in data_files:
+        file_metadata = pq.read_metadata(file_path)
+        file_metadata.set_file_path(
+            os.path.relpath(file_path, path).replace(os.sep, "/")
+        )
+        if metadata is None:
+            metadata = file_metadata
+        else:
+            metadata.append_row_groups(file_metadata)
+    metadata.write_metadata_file(f"{path}/._metadata")
+    os.replace(f"{path}/._metadata", f"{path}/_metadata")
+    pq.write_metadata(pq.read_schema(data_files[0]), f"{path}/._common_metadata")
+    os.replace(f"{path}/._common_metadata", f"{path}/_common_metadata")
+
+
+def remove_metadata_files(path):
+    """Remove the _metadata and _common_metadata summary files before new files are written to the dataset,
+    otherwise readers using them would keep reading the files of the earlier run"""
+    for file_name in ["_metadata", "_common_metadata"]:
+        if os.path.exists(f"{path}/{file_name}"):
+            os.remove(f"{path}/{file_name}")
+
+
+def remove_empty_directories(path):
+    """Remove the partition directories that became empty after the compaction"""
+    for root, dirs, files in os.walk(path, topdown=False):
+        if root != path and not dirs and not files:
+            os.rmdir(root)
+
+
+def compact_dataset(path, target_size_mb=128, profile=None):
+    """Compact a partitioned parquet dataset:
+    - drop the files of earlier runs, that are superseded by the latest run
+    - merge the small files of each partition up to target_size_mb
+    - rewrite the _metadata and _common_metadata summary files
+    New files are renamed into place and the summary files are replaced before any old file is deleted,
+    so a reader using _metadata (like read_dataset) sees either the old or the new set of files.
+    Readers that list the partition directories (like pd.read_parquet) can see the old and the new files
+    together, with duplicated rows, until the old files are deleted."""
+    data_files = list_data_files(path)
+    current, superseded = find_superseded_files(data_files)
+    merged_away = []
+    for files in plan_compaction(current, target_size_mb * 1024**2):
+        merged_file = merge_files(files, profile)
+        current = [f for f in current if f not in files] + [merged_file]
+        merged_away.extend(files)
+    write_metadata_files(path, sorted(current))
+    for file_path in superseded + merged_away:
+        os.remove(file_path)
+    remove_empty_directories(path)
+    log.info(
+        f"Compacted {path}: {len(data_files)} files -> {len(current)} files, "
+        f"{len(superseded)} superseded files dropped"
+    )
+    return {
+        "files_before": len(data_files),
+        "files_after": len(current),
+        "superseded_files": len(superseded),
+        "merged_files": len(merged_away),
+    }
+
+
+def compact_layer(path, target_size_mb=128, profile=None):
+    """Compact every partitioned dataset (directory) of a layer, single file tables are already compact"""
+    if not os.path.isdir(path):
+        log.warning(f"Layer {path} does not exist, nothing to compact")
+        return {}
+    results = {}
+    for name in sorted(os.listdir(path)):
+        dataset_path = f"{path}/{name}"
+        if os.path.isdir(dataset_path) and not name.startswith((".", "_")):
+            results[name] = compact_dataset(dataset_path, target_size_mb, profile)
+    return results
+
+
+def read_dataset(path, columns=None):
+    """Read a partitioned parquet dataset into a DataFrame, using the _metadata summary file when it exists
+    instead of listing the partition directories"""
+    # dictionaries can not be inferred, if a partition value is null (__HIVE_DEFAULT_PARTITION__)
+    partitioning = ds.HivePartitioning.discover(infer_dictionary=False)
+    if os.path.exists(f"{path}/_metadata"):
+        dataset = ds.parquet_dataset(f"{path}/_metadata", partitioning=partitioning)
+    else:
+        dataset = ds.dataset(path, format="parquet", partitioning=partitioning)
+    return dataset.to_table(columns=columns).to_pandas()
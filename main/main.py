@@ -1,6 +1,9 @@
 import sys
-from functools import reduce
+import time
+import tempfile
+import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 import os
 import argparse
 import logging
@@ -11,7 +14,12 @@ from utils import (
     capitalize_columns,
     columns_to_datetime,
     column_dropper,
+    parquet_write_options,
+    get_path_size,
+    aggregate_on_key,
+    join_positions,
 )
+from compaction import compact_layer, remove_metadata_files, run_basename
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
@@ -75,12 +83,15 @@ def fixing_schemas(dataframes):
     )
 
 
-def write_bronze_layer(dict_of_dataframes, path):
-    """Save data to the bronze layer in parquet files"""
+def write_bronze_layer(dict_of_dataframes, path, profile=None):
+    """Save data to the bronze layer in parquet files, using the bronze write profile if given"""
     os.makedirs(path, exist_ok=True)
     for key, dataframe in dict_of_dataframes.items():
         try:
-            dataframe.to_parquet(f"{path}/{key}_bronze.parquet")
+            dataframe.to_parquet(
+                f"{path}/{key}_bronze.parquet",
+                **parquet_write_options(profile, dataframe.columns),
+            )
             log.info(f"DataFrame {key} written to {path}")
         except Exception as e:
             log.error(f"Failed to write {key} due to {e}")
@@ -116,54 +127,185 @@ def clean_data(data_frames):
     )
 
 
-def write_silver_layer(dict_of_dataframes, path):
-    """Save cleaned data to silver layer"""
+def write_silver_layer(dict_of_dataframes, path, profile=None):
+    """Save cleaned data to silver layer, using the silver write profile if given"""
     os.makedirs(path, exist_ok=True)
     for key, dataframe in dict_of_dataframes.items():
         try:
-            dataframe.to_parquet(f"{path}/{key}_silver.parquet")
+            dataframe.to_parquet(
+                f"{path}/{key}_silver.parquet",
+                **parquet_write_options(profile, dataframe.columns),
+            )
             log.info(f"DataFrame {key} written to {path}")
         except Exception as e:
             log.error(f"Failed to write {key} due to {e}")
 
 
-def aggregate_data(data_frames):
+def aggregate_data(data_frames, review_features="order"):
     """Aggregate the data to make a couple of summarizations, take the mean of duplicated order reviews, check total price,
-    total freight cost of an orders, number of items in an order"""
-    data_frames["aggregated_reviews"] = (
-        data_frames["data_order_reviews"]
-        .groupby("order_id")
-        .agg({"review_score": "mean"})
-    )
-    data_frames["aggregated_order_payments"] = (
-        data_frames["data_order_payments"]
-        .groupby("order_id")
-        .agg(total_payment=("payment_value", "sum"))
-    )
-    data_frames["aggregated_order_items"] = (
-        data_frames["data_order_items"]
-        .groupby("order_id")
-        .agg(
+    total freight cost of an orders, number of items in an order. The order_ids of the orders and the three tables
+    are sorted once together, so the aggregates come out aligned on one order_id index, and the row positions of every
+    order_id on that index are kept, so merge_orders can join the tables by position.
+    With review_features="as_of" the review score of the order itself is left out, because it is written after the order,
+    and the point in time correct review features of the products are computed instead.
+    """
+    tables = [
+        (data_frames["data_orders"], {}),
+        (
+            data_frames["data_order_payments"],
+            {"total_payment": ("payment_value", "sum")},
+        ),
+        (
+            data_frames["data_order_items"],
             {
-                "price": "sum",
-                "freight_value": "sum",
-                "order_item_id": "max",
-            }
+                "total_order_value": ("price", "sum"),
+                "total_freight_value": ("freight_value", "sum"),
+                "number_of_items_ordered": ("order_item_id", "max"),
+            },
+        ),
+    ]
+    if review_features == "as_of":
+        data_frames["review_features"] = as_of_review_features(data_frames)
+    elif review_features == "order":
+        tables.append(
+            (
+                data_frames["data_order_reviews"],
+                {"review_score": ("review_score", "mean")},
+            )
         )
-        .rename(
-            columns={
-                "price": "total_order_value",
-                "freight_value": "total_freight_value",
-                "order_item_id": "number_of_items_ordered",
-            }
+    else:
+        raise ValueError(
+            f"Unknown review_features {review_features}, use order or as_of"
         )
+    data_frames["aggregated_orders"], positions = aggregate_on_key(
+        "order_id", *tables, return_positions=True
     )
+    # row positions of the orders, payments and items in aggregated_orders, merge_orders joins on them
+    data_frames["order_positions"] = {
+        "data_orders": positions[0],
+        "data_order_payments": positions[1],
+        "data_order_items": positions[2],
+    }
 
 
-def merge_data(data_frames):
-    """Create one big table with all the possibly relevant attributes of orders
-    merge the necessary tables into one, categorize columns"""
-    products = pd.merge(
+def purchase_week(timestamps):
+    """Start (Monday) of the week of the timestamps, the time unit of the sales forecast"""
+    return timestamps.dt.to_period("W").dt.start_time.astype(timestamps.dtype)
+
+
+def as_of_review_features(data_frames, partition_frequency="M"):
+    """Mean score and number of the reviews of each product, that were written before the week of a purchase,
+    for every product and week with a purchase. The reviews are sorted by review_creation_date and attached to the
+    weeks with merge_asof. The full reviews and weeks tables are built and sorted up front, and the features of every
+    partition are kept until they are concatenated at the end. The cumulative sums and the merge_asof run one time
+    partition (month) at a time, on the reviews of that partition only, the review totals of the earlier partitions
+    are carried over per product, so only these intermediates are bounded by the partition size.
+    """
+    items = data_frames["data_order_items"][["order_id", "product_id"]]
+    reviews = (
+        pd.merge(
+            data_frames["data_order_reviews"][
+                ["order_id", "review_score", "review_creation_date"]
+            ],
+            items.drop_duplicates(),
+            on="order_id",
+        )
+        .dropna(subset=["review_score", "review_creation_date"])
+        .sort_values("review_creation_date", kind="stable", ignore_index=True)
+    )
+    weeks = pd.merge(
+        data_frames["data_orders"][["order_id", "order_purchase_timestamp"]],
+        items,
+        on="order_id",
+    )
+    weeks["purchase_week"] = purchase_week(weeks["order_purchase_timestamp"])
+    weeks = (
+        weeks[["product_id", "purchase_week"]]
+        .drop_duplicates()
+        .sort_values("purchase_week", kind="stable", ignore_index=True)
+    )
+    reviews["review_creation_date"] = reviews["review_creation_date"].astype(
+        weeks["purchase_week"].dtype
+    )
+
+    totals = pd.DataFrame(
+        {"review_score_sum": pd.Series(dtype="float64"), "review_count": 0},
+        index=pd.Index([], name="product_id"),
+    )
+    features = []
+    start = 0
+    partitions = weeks["purchase_week"].dt.to_period(partition_frequency)
+    for _, partition in weeks.groupby(partitions, sort=True):
+        # reviews written before the last week of the partition, and not seen in earlier partitions
+        end = reviews["review_creation_date"].searchsorted(
+            partition["purchase_week"].iloc[-1], side="left"
+        )
+        partition_reviews = reviews.iloc[start:end].copy()
+        start = end
+        carried = totals.reindex(partition_reviews["product_id"], fill_value=0)
+        by_product = partition_reviews.groupby("product_id")
+        partition_reviews["review_score_sum"] = (
+            by_product["review_score"].cumsum().to_numpy()
+            + carried["review_score_sum"].to_numpy()
+        )
+        partition_reviews["review_count"] = (
+            by_product.cumcount().to_numpy() + 1 + carried["review_count"].to_numpy()
+        )
+        partition_features = pd.merge_asof(
+            partition,
+            partition_reviews[
+                [
+                    "product_id",
+                    "review_creation_date",
+                    "review_score_sum",
+                    "review_count",
+                ]
+            ],
+            left_on="purchase_week",
+            right_on="review_creation_date",
+            by="product_id",
+            allow_exact_matches=False,
+        )
+        # weeks without a review in this partition get the totals of the earlier partitions
+        previous = totals.reindex(partition_features["product_id"])
+        for column in ["review_score_sum", "review_count"]:
+            partition_features[column] = (
+                partition_features[column]
+                .fillna(pd.Series(previous[column].to_numpy()))
+                .fillna(0)
+            )
+        features.append(partition_features)
+        totals = (
+            partition_reviews.groupby("product_id")[
+                ["review_score_sum", "review_count"]
+            ]
+            .last()
+            .combine_first(totals)
+        )
+
+    if not features:
+        return pd.DataFrame(
+            columns=[
+                "product_id",
+                "purchase_week",
+                "product_review_score",
+                "product_review_count",
+            ]
+        )
+    features = pd.concat(features, ignore_index=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        features["product_review_score"] = (
+            features["review_score_sum"] / features["review_count"]
+        ).where(features["review_count"] > 0)
+    features["product_review_count"] = features["review_count"].astype("int64")
+    return features[
+        ["product_id", "purchase_week", "product_review_score", "product_review_count"]
+    ]
+
+
+def merge_products(data_frames):
+    """Join the english category names to the products"""
+    return pd.merge(
         data_frames["data_products"],
         data_frames["data_product_category_name_translation"],
         on="product_category_name",
@@ -177,20 +319,52 @@ def merge_data(data_frames):
         ["product_id", "original_category_name", "english_category_name"]
     ]
 
-    # join multiple tables on common key column
-    orders_assist_list = [
-        data_frames["data_orders"],
-        data_frames["data_order_items"],
-        data_frames["data_order_payments"],
-        data_frames["aggregated_order_payments"],
-        data_frames["aggregated_order_items"],
-        data_frames["aggregated_reviews"],
-    ]
 
-    orders_df = reduce(
-        lambda left, right: pd.merge(left, right, on="order_id", how="inner"),
-        orders_assist_list,
+def merge_orders(data_frames):
+    """Join the order items, payments and the aggregated tables to the orders by the order_id positions
+    of aggregate_data, which is an inner join on order_id without hashing the keys,
+    and the as of review features of the products on the product and the week of the purchase
+    """
+    positions = data_frames["order_positions"]
+    size = len(data_frames["aggregated_orders"])
+    order_rows, item_rows = join_positions(
+        positions["data_orders"], positions["data_order_items"], size
+    )
+    item_pairs, payment_rows = join_positions(
+        positions["data_order_items"][item_rows],
+        positions["data_order_payments"],
+        size,
     )
+    # every table is taken in the same row order, so joining them is a side by side concatenation
+    parts = [
+        data_frames["data_orders"].iloc[order_rows[item_pairs]],
+        data_frames["data_order_items"]
+        .drop("order_id", axis=1)
+        .iloc[item_rows[item_pairs]],
+        data_frames["data_order_payments"].drop("order_id", axis=1).iloc[payment_rows],
+        data_frames["aggregated_orders"].iloc[
+            positions["data_order_payments"][payment_rows]
+        ],
+    ]
+    orders_df = pd.concat([part.reset_index(drop=True) for part in parts], axis=1)
+    if "review_features" in data_frames:
+        orders_df["purchase_week"] = purchase_week(
+            orders_df["order_purchase_timestamp"]
+        )
+        orders_df = pd.merge(
+            orders_df,
+            data_frames["review_features"],
+            on=["product_id", "purchase_week"],
+            how="left",
+        ).drop("purchase_week", axis=1)
+    return orders_df
+
+
+def merge_data(data_frames):
+    """Create one big table with all the possibly relevant attributes of orders
+    merge the necessary tables into one, categorize columns"""
+    products = merge_products(data_frames)
+    orders_df = merge_orders(data_frames)
     orders_with_sellers_df = pd.merge(
         orders_df, data_frames["data_sellers"], on="seller_id", how="left"
     )
@@ -209,15 +383,241 @@ def merge_data(data_frames):
     return big_table
 
 
-def write_gold_layer(data_frame, path, partition_on):
-    """Save the final result to gold layer. Partition by product categories. There is too many items to partition on that"""
+def add_surrogate_key(data_frame, key_column):
+    """Number the rows of a dimension table, the compact key is the position of the row"""
+    data_frame = data_frame.reset_index(drop=True)
+    data_frame.insert(0, key_column, np.arange(len(data_frame), dtype="int32"))
+    return data_frame
+
+
+def add_missing_members(data_frame, id_column, ids):
+    """Append a row with empty attributes for the ids that are referenced but missing from the dimension,
+    so the natural id is kept like a left join would keep it"""
+    missing_ids = pd.Index(ids.dropna().unique()).difference(data_frame[id_column])
+    if missing_ids.empty:
+        return data_frame
+    return pd.concat(
+        [data_frame, pd.DataFrame({id_column: missing_ids})], ignore_index=True
+    )
+
+
+def lookup_surrogate_key(dimension, id_column, ids):
+    """Translate natural ids to the compact keys of a dimension, ids missing from the dimension get -1"""
+    return pd.Index(dimension[id_column]).get_indexer(ids).astype("int32")
+
+
+def build_star_schema(data_frames):
+    """Alternative gold model to the big table: a narrow fact table of order items, and customer, seller,
+    product and category dimension tables, that the fact table references by compact integer keys
+    """
+    products = merge_products(data_frames)
+    dim_category = add_surrogate_key(
+        products[["original_category_name", "english_category_name"]]
+        .drop_duplicates()
+        .astype("category"),
+        "category_key",
+    )
+    dim_product = add_surrogate_key(
+        pd.merge(
+            products,
+            dim_category,
+            on=["original_category_name", "english_category_name"],
+            how="left",
+        )[["product_id", "category_key"]],
+        "product_key",
+    )
+
+    fact = merge_orders(data_frames)
+    # same join types as merge_data: inner join with products, left join with sellers and customers
+    fact["product_key"] = lookup_surrogate_key(
+        dim_product, "product_id", fact["product_id"]
+    )
+    fact = fact[fact["product_key"] >= 0].reset_index(drop=True)
+    dim_seller = add_surrogate_key(
+        add_missing_members(
+            data_frames["data_sellers"], "seller_id", fact["seller_id"]
+        ),
+        "seller_key",
+    )
+    dim_customer = add_surrogate_key(
+        add_missing_members(
+            data_frames["data_customers"].drop("customer_unique_id", axis=1),
+            "customer_id",
+            fact["customer_id"],
+        ),
+        "customer_key",
+    )
+    fact["seller_key"] = lookup_surrogate_key(
+        dim_seller, "seller_id", fact["seller_id"]
+    )
+    fact["customer_key"] = lookup_surrogate_key(
+        dim_customer, "customer_id", fact["customer_id"]
+    )
+    fact = fact.drop(["order_status", "customer_id", "seller_id", "product_id"], axis=1)
+    return {
+        "fact_order_items": fact,
+        # the big table drops the customer ids as well, customer_key identifies the customer
+        "dim_customer": dim_customer.drop("customer_id", axis=1),
+        "dim_seller": dim_seller,
+        "dim_product": dim_product,
+        "dim_category": dim_category,
+    }
+
+
+def write_star_schema(tables, path, profile=None):
+    """Save the fact and dimension tables of the star schema to the gold layer"""
+    os.makedirs(path, exist_ok=True)
+    for key, dataframe in tables.items():
+        try:
+            dataframe.to_parquet(
+                f"{path}/{key}_gold.parquet",
+                **parquet_write_options(profile, dataframe.columns),
+            )
+            log.info(f"DataFrame {key} written to {path}")
+        except Exception as e:
+            log.error(f"Failed to write {key} due to {e}")
+
+
+# dimension table: (key column in the referencing table, referencing table)
+STAR_SCHEMA_DIMENSIONS = {
+    "dim_customer": ("customer_key", "fact_order_items"),
+    "dim_seller": ("seller_key", "fact_order_items"),
+    "dim_product": ("product_key", "fact_order_items"),
+    "dim_category": ("category_key", "dim_product"),
+}
+
+
+def read_star_schema(path, columns=None):
+    """Read the star schema gold layer into one table, joining only the dimensions that hold a requested column
+    and reading only the requested columns of them. Without columns every column is read, like the big table.
+    The keys are row positions of the dimensions, so the join is a positional take instead of a hash merge.
+    """
+    table_columns = {
+        name: pq.read_schema(f"{path}/{name}_gold.parquet").names
+        for name in ["fact_order_items", *STAR_SCHEMA_DIMENSIONS]
+    }
+    keys = {key for key, _ in STAR_SCHEMA_DIMENSIONS.values()}
+    if columns is None:
+        columns = [
+            column
+            for name, names in table_columns.items()
+            for column in names
+            if column not in keys
+        ]
+    requested_keys = keys.intersection(columns)
+    if requested_keys:
+        raise ValueError(
+            f"Columns {sorted(requested_keys)} are join keys of the star schema, they can not be requested"
+        )
+    requested = {
+        name: [c for c in names if c in columns]
+        for name, names in table_columns.items()
+    }
+    missing = set(columns) - {c for names in requested.values() for c in names}
+    if missing:
+        raise ValueError(f"Columns {sorted(missing)} not found in the star schema")
+
+    # a dimension is needed if a column is requested from it, or it references a needed dimension
+    needed = {name for name in STAR_SCHEMA_DIMENSIONS if requested[name]}
+    for name, (_, referencing) in reversed(STAR_SCHEMA_DIMENSIONS.items()):
+        if name in needed and referencing != "fact_order_items":
+            needed.add(referencing)
+    read_columns = {
+        name: requested[name]
+        + [
+            key
+            for dim, (key, ref) in STAR_SCHEMA_DIMENSIONS.items()
+            if ref == name and dim in needed
+        ]
+        for name in ["fact_order_items", *STAR_SCHEMA_DIMENSIONS]
+    }
+
+    result = pd.read_parquet(
+        f"{path}/fact_order_items_gold.parquet",
+        columns=read_columns["fact_order_items"],
+    )
+    for name, (key, _) in STAR_SCHEMA_DIMENSIONS.items():
+        if name not in needed:
+            continue
+        dimension = pd.read_parquet(
+            f"{path}/{name}_gold.parquet", columns=read_columns[name]
+        )
+        positions = result.pop(key).to_numpy()
+        for column in dimension.columns:
+            result[column] = dimension[column].array.take(positions, allow_fill=True)
+    return result[list(columns)]
+
+
+def write_gold_layer(data_frame, path, partition_on, profile=None):
+    """Save the final result to gold layer. Partition by product categories. There is too many items to partition on that.
+    The file names carry a run marker, so compaction can tell the latest run. Returns whether the write succeeded
+    """
     os.makedirs(path, exist_ok=True)
     file_path = f"{path}/big_table_gold.parquet"
     try:
-        data_frame.to_parquet(file_path, partition_cols=partition_on)
+        remove_metadata_files(file_path)
+        data_frame.to_parquet(
+            file_path,
+            partition_cols=partition_on,
+            basename_template=run_basename(),
+            **parquet_write_options(profile, data_frame.columns),
+        )
         log.info(f"DataFrame written to {file_path}")
+        return True
     except Exception as e:
         log.error(f"Failed to write {data_frame} due to {e}")
+        return False
+
+
+def benchmark_parquet_profiles(data_frames, profiles):
+    """Write and read back every DataFrame with each parquet write profile, and measure
+    the size on disk, the write time and the read time of the profiles"""
+    results = []
+    for profile_name, profile in profiles.items():
+        size, write_time, read_time = 0, 0.0, 0.0
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for key, dataframe in data_frames.items():
+                file_path = f"{temp_dir}/{key}.parquet"
+                start = time.perf_counter()
+                dataframe.to_parquet(
+                    file_path, **parquet_write_options(profile, dataframe.columns)
+                )
+                write_time += time.perf_counter() - start
+                start = time.perf_counter()
+                pd.read_parquet(file_path)
+                read_time += time.perf_counter() - start
+                size += get_path_size(file_path)
+        results.append(
+            {
+                "profile": profile_name,
+                "size_mb": size / 1024**2,
+                "write_seconds": write_time,
+                "read_seconds": read_time,
+            }
+        )
+        log.info(f"Benchmarked parquet profile {profile_name}")
+    return pd.DataFrame(results).set_index("profile")
+
+
+def compact_layers(config, skip_layers=()):
+    """Compact the partitioned datasets of the layers listed in the compaction section of the config,
+    except the skip_layers"""
+    compaction = config.get("compaction", {})
+    profiles = config.get("parquet_profiles", {})
+    results = {}
+    for layer in compaction.get("layers", []):
+        if layer in skip_layers:
+            log.warning(f"Skipping the compaction of the {layer} layer")
+            continue
+        layer_path = (
+            f"{config['paths']['output_folder']}/{config['paths'][f'{layer}_layer']}"
+        )
+        results[layer] = compact_layer(
+            layer_path,
+            compaction.get("target_file_size_mb", 128),
+            profiles.get(layer),
+        )
+    return results
 
 
 def main(args):
@@ -225,20 +625,39 @@ def main(args):
     files_list = config["files"]
     input_folder = config["paths"]["input_folder"]
     output_folder = config["paths"]["output_folder"]
+    profiles = config.get("parquet_profiles", {})
 
-    bronze_path = f"{output_folder}/{config['paths']['bronze_layer']}"
+    if args.compact:
+        compact_layers(config)
+        return
     data_frames = load_data(input_folder, files_list)
     fixing_schemas(data_frames)
-    write_bronze_layer(data_frames, bronze_path)
+    if args.benchmark_profiles:
+        print(benchmark_parquet_profiles(data_frames, profiles))
+        return
+    bronze_path = f"{output_folder}/{config['paths']['bronze_layer']}"
+    write_bronze_layer(data_frames, bronze_path, profiles.get("bronze"))
     clean_data(data_frames)
     silver_path = f"{output_folder}/{config['paths']['silver_layer']}"
-    write_silver_layer(data_frames, silver_path)
-    aggregate_data(data_frames)
-    big_table = merge_data(data_frames)
+    write_silver_layer(data_frames, silver_path, profiles.get("silver"))
+    aggregate_data(data_frames, config.get("review_features", "order"))
     gold_path = f"{output_folder}/{config['paths']['gold_layer']}"
-    partition_cols = config["partition_columns"]
-    write_gold_layer(big_table, gold_path, partition_cols)
-    print(big_table.dtypes)
+    if config.get("gold_model", "wide") == "star":
+        tables = build_star_schema(data_frames)
+        write_star_schema(tables, gold_path, profiles.get("gold"))
+        gold_dtypes = tables["fact_order_items"].dtypes
+        gold_written = True
+    else:
+        big_table = merge_data(data_frames)
+        partition_cols = config["partition_columns"]
+        gold_written = write_gold_layer(
+            big_table, gold_path, partition_cols, profiles.get("gold")
+        )
+        gold_dtypes = big_table.dtypes
+    if config.get("compaction", {}).get("after_etl", False):
+        # a partially written run would count as the latest one, and compaction would drop the previous run
+        compact_layers(config, skip_layers=() if gold_written else ("gold",))
+    print(gold_dtypes)
 
 
 def arg_parser():
@@ -250,6 +669,16 @@ def arg_parser():
         default="param_config.yaml",
         help="Path to the configuration file",
     )
+    parser.add_argument(
+        "--benchmark_profiles",
+        action="store_true",
+        help="Benchmark size, write and read speed of the parquet profiles instead of running the ETL",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Compact the partitioned datasets of the layers in the compaction config instead of running the ETL",
+    )
     arguments = parser.parse_args()
     return arguments
 
@@ -1,3 +1,5 @@
+import os
+import numpy as np
 import pandas as pd
 
 
@@ -116,3 +118,158 @@ def column_dropper(*dataframes, **column_lists):
                 dataframe.drop(column_lists[column_key], axis=1, inplace=True)
             else:
                 raise ValueError(f"No column list provided for DataFrame {i}")
+
+
+SUPPORTED_PARQUET_CODECS = ("zstd", "lz4", "snappy")
+
+
+def parquet_write_options(profile, columns=None):
+    """Translate a parquet write profile from the config into keyword arguments for DataFrame.to_parquet
+    Parameters:
+    - profile: Dictionary with the optional keys 'compression', 'compression_level', 'use_dictionary',
+               'use_byte_stream_split', 'row_group_size', 'index' and 'write_page_index'.
+               None or an empty dictionary keeps the pandas/pyarrow defaults.
+    - columns: Columns of the DataFrame that is going to be written. Per column encodings are narrowed
+               down to these, so one profile can be shared by every table of a layer.
+    pyarrow prefers dictionary encoding over byte stream split, so the columns listed in 'use_byte_stream_split'
+    are taken out of 'use_dictionary', 'use_dictionary: true' means every other column.
+    """
+    if not profile:
+        return {}
+    options = dict(profile)
+    codec = options.get("compression", "snappy")
+    if codec not in SUPPORTED_PARQUET_CODECS:
+        raise ValueError(
+            f"Unsupported parquet compression {codec}, choose one of {SUPPORTED_PARQUET_CODECS}"
+        )
+    if codec == "snappy" and options.get("compression_level") is not None:
+        raise ValueError("Compression level can not be set for snappy compression")
+    if columns is not None:
+        for encoding in ("use_dictionary", "use_byte_stream_split"):
+            if isinstance(options.get(encoding), list):
+                options[encoding] = [
+                    column for column in options[encoding] if column in columns
+                ]
+    byte_stream_split = options.get("use_byte_stream_split")
+    if isinstance(byte_stream_split, list) and byte_stream_split:
+        dictionary = options.get("use_dictionary", True)
+        if dictionary is True:
+            if columns is None:
+                raise ValueError(
+                    "Columns are needed to combine use_dictionary: true with use_byte_stream_split columns"
+                )
+            dictionary = list(columns)
+        if isinstance(dictionary, list):
+            options["use_dictionary"] = [
+                column for column in dictionary if column not in byte_stream_split
+            ]
+    return options
+
+
+def get_path_size(path):
+    """Return the size of a file, or the total size of every file under a directory, in bytes"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total_size = 0
+    for root, _, files in os.walk(path):
+        for file_name in files:
+            total_size += os.path.getsize(os.path.join(root, file_name))
+    return total_size
+
+
+def reduce_segments(values, starts, function):
+    """Reduce the contiguous runs of values that start at the given positions, NaN values are skipped like in groupby"""
+    if function == "sum":
+        return np.add.reduceat(np.nan_to_num(values), starts)
+    elif function == "mean":
+        not_nan = ~np.isnan(values)
+        sums = np.add.reduceat(np.where(not_nan, values, 0), starts)
+        counts = np.add.reduceat(not_nan, starts)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return sums / counts
+    elif function == "max":
+        return np.fmax.reduceat(values, starts)
+    raise ValueError(f"Unsupported aggregation {function}, use sum, mean or max")
+
+
+def aggregate_on_key(key, *tables, return_positions=False):
+    """Aggregate several DataFrames on a common key column in one go: the keys of every DataFrame are sorted
+    together once, then each aggregation is a reduction over the contiguous runs of equal keys.
+    Every result is placed on the same sorted key index, so they are put side by side without joins.
+    Parameters:
+    - key: Column present in every DataFrame.
+    - *tables: (dataframe, aggregations) tuples, aggregations is a dictionary where keys are the output
+               column names and values are (column, function) tuples, function is 'sum', 'mean' or 'max'.
+    - return_positions: Also return, for every DataFrame, the row position in the result of the key of each row
+                        (-1 for keys that are not in the result), to join the DataFrames by position with join_positions.
+    Returns one DataFrame indexed by the sorted keys that are present in every DataFrame,
+    the same as chaining groupby aggregations with inner joins on the key.
+    """
+    keys = pd.concat(
+        [dataframe[key] for dataframe, _ in tables], ignore_index=True
+    ).array
+    order = np.asarray(keys.argsort(kind="stable"))
+    sorted_keys = keys.take(order)
+    is_new_key = np.r_[True, np.asarray(sorted_keys[1:] != sorted_keys[:-1])]
+    is_new_key = is_new_key[: len(keys)]
+    codes = np.empty(len(keys), dtype=np.intp)
+    codes[order] = np.cumsum(is_new_key) - 1
+    group_keys = sorted_keys.take(np.flatnonzero(is_new_key))
+
+    present = np.ones(len(group_keys), dtype=bool)
+    columns = {}
+    offset = 0
+    for dataframe, aggregations in tables:
+        # the rows of this DataFrame in key order, taken from the common sort
+        in_table = (order >= offset) & (order < offset + len(dataframe))
+        table_order = order[in_table] - offset
+        table_codes = codes[offset : offset + len(dataframe)][table_order]
+        offset += len(dataframe)
+        starts = np.flatnonzero(np.r_[True, table_codes[1:] != table_codes[:-1]])
+        starts = starts[: len(table_codes)]
+        groups = table_codes[starts]
+        table_present = np.zeros(len(group_keys), dtype=bool)
+        table_present[groups] = True
+        present &= table_present
+        for output_column, (column, function) in aggregations.items():
+            values = dataframe[column].to_numpy()[table_order]
+            reduced = (
+                reduce_segments(values, starts, function) if len(values) else values
+            )
+            # groups missing from this DataFrame are dropped by the present mask
+            columns[output_column] = np.empty(len(group_keys), dtype=reduced.dtype)
+            columns[output_column][groups] = reduced
+    result = pd.DataFrame(
+        {column: values[present] for column, values in columns.items()},
+        index=pd.Index(group_keys.take(np.flatnonzero(present)), name=key),
+    )
+    if not return_positions:
+        return result
+    result_positions = np.where(present, np.cumsum(present) - 1, -1)
+    positions = []
+    offset = 0
+    for dataframe, _ in tables:
+        positions.append(result_positions[codes[offset : offset + len(dataframe)]])
+        offset += len(dataframe)
+    return result, positions
+
+
+def join_positions(left, right, size):
+    """Inner join of two arrays of row positions (in range(size), -1 means no match) without hashing:
+    both sides are grouped by a stable integer sort, and every left row of a position is paired with every
+    right row of the same position.
+    Returns the row numbers of the left and the right array for each pair, ordered by position.
+    """
+    left_order = np.argsort(left, kind="stable")
+    right_order = np.argsort(right, kind="stable")
+    left_counts = np.bincount(left[left >= 0], minlength=size)
+    right_counts = np.bincount(right[right >= 0], minlength=size)
+    # the -1 positions are sorted to the front
+    left_starts = np.cumsum(left_counts) - left_counts + np.count_nonzero(left < 0)
+    right_starts = np.cumsum(right_counts) - right_counts + np.count_nonzero(right < 0)
+    pairs = left_counts * right_counts
+    group = np.repeat(np.arange(size), pairs)
+    offset = np.arange(pairs.sum()) - np.repeat(np.cumsum(pairs) - pairs, pairs)
+    left_rows = left_order[left_starts[group] + offset // right_counts[group]]
+    right_rows = right_order[right_starts[group] + offset % right_counts[group]]
+    return left_rows, right_rows
@@ -0,0 +1,132 @@
+import os
+from unittest.mock import patch
+import pytest
+import pandas as pd
+
+from main.compaction import (
+    list_data_files,
+    find_superseded_files,
+    plan_compaction,
+    compact_dataset,
+    compact_layer,
+    read_dataset,
+    run_basename,
+)
+from main.main import write_gold_layer
+
+
+@pytest.fixture
+def gold_data_frame():
+    return pd.DataFrame(
+        {
+            "order_id": [f"o{i}" for i in range(30)],
+            "price": [float(i) for i in range(30)],
+            "english_category_name": ["books", "toys", "garden"] * 10,
+        }
+    )
+
+
+@pytest.fixture
+def dataset_path(tmp_path, gold_data_frame):
+    """Gold dataset written by two runs, the second one split into many small files"""
+    path = str(tmp_path / "big_table_gold.parquet")
+    gold_data_frame.to_parquet(
+        path,
+        partition_cols=["english_category_name"],
+        basename_template=run_basename(1),
+    )
+    gold_data_frame.to_parquet(
+        path,
+        partition_cols=["english_category_name"],
+        basename_template=run_basename(2),
+        max_rows_per_file=2,
+        row_group_size=2,
+    )
+    return path
+
+
+def test_find_superseded_files(dataset_path):
+    current, superseded = find_superseded_files(list_data_files(dataset_path))
+    assert len(superseded) == 3, "Every partition of the first run is superseded"
+    assert len(current) == 15
+
+
+def test_plan_compaction(dataset_path):
+    current, _ = find_superseded_files(list_data_files(dataset_path))
+    bins = plan_compaction(current, target_size=10 * 1024**2)
+    assert len(bins) == 3, "One merge per partition"
+    assert all(len({os.path.dirname(f) for f in files}) == 1 for files in bins)
+    assert plan_compaction(current, target_size=1) == []
+
+
+def test_compact_dataset(dataset_path, gold_data_frame):
+    result = compact_dataset(dataset_path, target_size_mb=10)
+    assert result == {
+        "files_before": 18,
+        "files_after": 3,
+        "superseded_files": 3,
+        "merged_files": 15,
+    }
+    assert len(list_data_files(dataset_path)) == 3
+    assert os.path.exists(f"{dataset_path}/_metadata")
+    assert os.path.exists(f"{dataset_path}/_common_metadata")
+    compacted = read_dataset(dataset_path).sort_values("price", ignore_index=True)
+    assert compacted["order_id"].tolist() == gold_data_frame["order_id"].tolist()
+    assert pd.read_parquet(dataset_path).shape == (30, 3), "No duplicated rows left"
+
+
+def test_compact_dataset_is_idempotent(dataset_path):
+    compact_dataset(dataset_path, target_size_mb=10)
+    result = compact_dataset(dataset_path, target_size_mb=10)
+    assert result["files_before"] == result["files_after"] == 3
+    assert result["superseded_files"] == result["merged_files"] == 0
+
+
+def test_compact_layer_skips_single_files(tmp_path, dataset_path):
+    pd.DataFrame({"col1": [1, 2]}).to_parquet(tmp_path / "data_test_silver.parquet")
+    results = compact_layer(str(tmp_path), target_size_mb=10)
+    assert list(results) == ["big_table_gold.parquet"]
+    assert compact_layer(str(tmp_path / "missing")) == {}
+
+
+@patch("main.main.run_basename", side_effect=[run_basename(1), run_basename(2)])
+def test_read_dataset_after_new_run(mock_run_basename, tmp_path, gold_data_frame):
+    write_gold_layer(gold_data_frame, str(tmp_path), ["english_category_name"])
+    dataset_path = str(tmp_path / "big_table_gold.parquet")
+    compact_dataset(dataset_path, target_size_mb=10)
+    new_run = gold_data_frame.assign(price=gold_data_frame["price"] + 100)
+    write_gold_layer(new_run, str(tmp_path), ["english_category_name"])
+    assert not os.path.exists(f"{dataset_path}/_metadata")
+    assert read_dataset(dataset_path)["price"].max() >= 100, "New run is read"
+    compact_dataset(dataset_path, target_size_mb=10)
+    assert read_dataset(dataset_path)["price"].min() == 100
+    assert mock_run_basename.call_count == 2
+
+
+def test_find_superseded_files_orders_runs_by_marker(tmp_path, gold_data_frame):
+    """The run marker decides the latest run, even when the modification times are equal"""
+    path = str(tmp_path / "big_table_gold.parquet")
+    for marker in [2, 10]:
+        gold_data_frame.to_parquet(
+            path,
+            partition_cols=["english_category_name"],
+            basename_template=run_basename(marker),
+        )
+    data_files = list_data_files(path)
+    for file_path in data_files:
+        os.utime(file_path, ns=(0, 0))
+    current, superseded = find_superseded_files(data_files)
+    assert all(os.path.basename(f).startswith("10-") for f in current)
+    assert all(os.path.basename(f).startswith("2-") for f in superseded)
+
+
+def test_read_dataset_null_partition(tmp_path, gold_data_frame):
+    gold_data_frame.loc[:4, "english_category_name"] = None
+    path = str(tmp_path / "big_table_gold.parquet")
+    gold_data_frame.to_parquet(path, partition_cols=["english_category_name"])
+    assert os.path.isdir(f"{path}/english_category_name=__HIVE_DEFAULT_PARTITION__")
+    for _ in range(2):
+        data = read_dataset(path)
+        assert len(data) == 30
+        assert data["english_category_name"].isna().sum() == 5
+        compact_dataset(path, target_size_mb=10)
@@ -1,9 +1,11 @@
 import tempfile
+from functools import reduce
 import pytest
 import yaml
 import os
+import numpy as np
 import pandas as pd
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, ANY
 
 
 from main.main import (
@@ -13,6 +15,15 @@ from main.main import (
     write_bronze_layer,
     write_silver_layer,
     write_gold_layer,
+    benchmark_parquet_profiles,
+    aggregate_data,
+    merge_data,
+    build_star_schema,
+    write_star_schema,
+    read_star_schema,
+    as_of_review_features,
+    merge_orders,
+    compact_layers,
 )
 
 
@@ -214,14 +225,233 @@ def test_write_gold_layer(mock_to_parquet, mock_makedirs, sample_data_frame):
     partition_on = ["english_category_name"]
 
     # Call the function with the sample DataFrame
-    write_gold_layer(sample_data_frame, path, partition_on)
+    assert write_gold_layer(sample_data_frame, path, partition_on)
 
     # Check if the directory creation method works
     mock_makedirs.assert_called_once_with(path, exist_ok=True)
 
     # Check if the to_parquet method is working properly
     file_path = f"{path}/big_table_gold.parquet"
-    mock_to_parquet.assert_called_once_with(file_path, partition_cols=partition_on)
+    mock_to_parquet.assert_called_once_with(
+        file_path, partition_cols=partition_on, basename_template=ANY
+    )
+    # file names start with the run marker
+    marker = mock_to_parquet.call_args.kwargs["basename_template"].split("-")[0]
+    assert marker.isdigit()
+
+
+@patch("os.makedirs")
+@patch("pandas.DataFrame.to_parquet", side_effect=OSError("disk full"))
+def test_write_gold_layer_failure(mock_to_parquet, mock_makedirs, sample_data_frame):
+    assert not write_gold_layer(
+        sample_data_frame, "/fake/path", ["english_category_name"]
+    )
+
+
+@patch("os.makedirs")
+@patch("pandas.DataFrame.to_parquet")
+def test_write_gold_layer_with_profile(
+    mock_to_parquet, mock_makedirs, sample_data_frame
+):
+    profile = {"compression": "lz4", "row_group_size": 1000, "index": False}
+    write_gold_layer(
+        sample_data_frame, "/fake/path", ["english_category_name"], profile
+    )
+    mock_to_parquet.assert_called_once_with(
+        "/fake/path/big_table_gold.parquet",
+        partition_cols=["english_category_name"],
+        basename_template=ANY,
+        compression="lz4",
+        row_group_size=1000,
+        index=False,
+    )
+
+
+@patch("main.main.compact_layer")
+def test_compact_layers_skip_layers(mock_compact_layer, config_data):
+    config_data["compaction"] = {"layers": ["silver", "gold"]}
+    results = compact_layers(config_data, skip_layers=("gold",))
+    assert list(results) == ["silver"]
+    mock_compact_layer.assert_called_once_with("/path/to/output/silver", 128, None)
+
+
+def test_benchmark_parquet_profiles(sample_data_frames):
+    profiles = {
+        "small": {"compression": "zstd", "compression_level": 19, "index": False},
+        "fast": {"compression": "lz4", "write_page_index": True},
+    }
+    results = benchmark_parquet_profiles(sample_data_frames, profiles)
+    assert list(results.index) == ["small", "fast"]
+    assert (results["size_mb"] > 0).all()
+    assert (results[["write_seconds", "read_seconds"]] >= 0).all().all()
+
+
+@pytest.fixture
+def etl_data_frames():
+    """Cleaned tables, with a seller missing from the sellers and a product without a category"""
+    data_frames = {
+        "data_orders": pd.DataFrame(
+            {
+                "order_id": ["o1", "o2", "o3"],
+                "customer_id": ["c1", "c2", "c1"],
+                "order_status": ["delivered"] * 3,
+                "order_purchase_timestamp": pd.to_datetime(
+                    ["2018-01-01", "2018-01-02", "2018-01-09"]
+                ),
+            }
+        ),
+        "data_order_items": pd.DataFrame(
+            {
+                "order_id": ["o1", "o1", "o2", "o3"],
+                "order_item_id": [1, 2, 1, 1],
+                "product_id": ["p1", "p2", "p1", "p3"],
+                "seller_id": ["s1", "s2", "s1", "s3"],
+                "price": [10.0, 20.0, 10.0, 5.0],
+                "freight_value": [1.0, 2.0, 1.0, 0.5],
+            }
+        ),
+        "data_order_payments": pd.DataFrame(
+            {"order_id": ["o1", "o2", "o3"], "payment_value": [33.0, 11.0, 5.5]}
+        ),
+        "data_order_reviews": pd.DataFrame(
+            {"order_id": ["o1", "o2", "o3"], "review_score": [5, 3, 4]}
+        ),
+        "data_customers": pd.DataFrame(
+            {
+                "customer_id": ["c1", "c2"],
+                "customer_unique_id": ["u1", "u2"],
+                "customer_city": ["Sao Paulo", "Rio De Janeiro"],
+                "customer_state": ["SP", "RJ"],
+            }
+        ),
+        "data_sellers": pd.DataFrame(
+            {
+                "seller_id": ["s1", "s2"],
+                "seller_city": ["Curitiba", "Sao Paulo"],
+                "seller_state": ["PR", "SP"],
+            }
+        ),
+        "data_products": pd.DataFrame(
+            {
+                "product_id": ["p1", "p2", "p3"],
+                "product_category_name": ["livros", "brinquedos", None],
+            }
+        ),
+        "data_product_category_name_translation": pd.DataFrame(
+            {
+                "product_category_name": ["livros", "brinquedos"],
+                "product_category_name_english": ["books", "toys"],
+            }
+        ),
+    }
+    aggregate_data(data_frames)
+    return data_frames
+
+
+def test_aggregate_data(etl_data_frames):
+    aggregated = etl_data_frames["aggregated_orders"]
+    assert list(aggregated.index) == ["o1", "o2", "o3"]
+    assert aggregated.columns.tolist() == [
+        "total_payment",
+        "total_order_value",
+        "total_freight_value",
+        "number_of_items_ordered",
+        "review_score",
+    ]
+    assert aggregated.loc["o1"].tolist() == [33.0, 30.0, 3.0, 2, 5.0]
+
+
+def test_merge_orders_matches_hash_merge(etl_data_frames):
+    """Joining by the order_id positions gives the same rows as inner merges on order_id"""
+    etl_data_frames["data_order_payments"] = pd.DataFrame(
+        {"order_id": ["o1", "o1", "o3", "o9"], "payment_value": [30.0, 3.0, 5.5, 1.0]}
+    )
+    aggregate_data(etl_data_frames)
+    orders_df = merge_orders(etl_data_frames)
+    expected = reduce(
+        lambda left, right: pd.merge(left, right, on="order_id", how="inner"),
+        [
+            etl_data_frames["data_orders"],
+            etl_data_frames["data_order_items"],
+            etl_data_frames["data_order_payments"],
+            etl_data_frames["aggregated_orders"],
+        ],
+    )
+    sort_by = ["order_id", "order_item_id", "payment_value"]
+    assert orders_df.sort_values(sort_by, ignore_index=True).equals(
+        expected.sort_values(sort_by, ignore_index=True)
+    )
+    assert len(orders_df) == 5
+
+
+def test_as_of_review_features(etl_data_frames):
+    etl_data_frames["data_order_reviews"]["review_creation_date"] = pd.to_datetime(
+        ["2018-01-03", "2018-01-08", "2018-01-20"]
+    )
+    features = as_of_review_features(etl_data_frames).set_index(
+        ["product_id", "purchase_week"]
+    )
+    # o1 review (p1, p2) is written in the week of the purchase, so only known from the next week
+    assert features.loc[("p1", pd.Timestamp("2018-01-01")), "product_review_count"] == 0
+    assert features.loc[("p3", pd.Timestamp("2018-01-08")), "product_review_count"] == 0
+    assert np.isnan(
+        features.loc[("p1", pd.Timestamp("2018-01-01")), "product_review_score"]
+    )
+    assert len(features) == 3
+
+
+def test_aggregate_data_as_of(etl_data_frames):
+    etl_data_frames["data_order_reviews"]["review_creation_date"] = pd.to_datetime(
+        ["2017-12-20", "2018-01-08", "2018-01-20"]
+    )
+    aggregate_data(etl_data_frames, review_features="as_of")
+    assert "review_score" not in etl_data_frames["aggregated_orders"].columns
+    big_table = merge_data(etl_data_frames).set_index(["order_id", "order_item_id"])
+    assert big_table.loc[("o2", 1), "product_review_score"] == 5.0
+    assert big_table.loc[("o3", 1), "product_review_count"] == 0
+    with pytest.raises(ValueError):
+        aggregate_data(etl_data_frames, review_features="future")
+
+
+def test_build_star_schema(etl_data_frames):
+    tables = build_star_schema(etl_data_frames)
+    fact = tables["fact_order_items"]
+    assert len(fact) == 4
+    assert fact["seller_key"].tolist() == [0, 1, 0, 2]
+    assert tables["dim_seller"]["seller_id"].tolist() == ["s1", "s2", "s3"]
+    assert tables["dim_seller"]["seller_city"].isna().tolist() == [False, False, True]
+    assert "seller_city" not in fact.columns
+    assert len(tables["dim_category"]) == 3
+    assert tables["dim_product"]["category_key"].tolist() == [0, 1, 2]
+
+
+def test_read_star_schema(tmp_path, etl_data_frames):
+    write_star_schema(build_star_schema(etl_data_frames), str(tmp_path))
+    big_table = merge_data(etl_data_frames)
+    star_table = read_star_schema(str(tmp_path))
+    sort_by = ["order_id", "order_item_id"]
+    big_table = big_table.sort_values(sort_by, ignore_index=True)
+    star_table = star_table.sort_values(sort_by, ignore_index=True)
+    assert sorted(star_table.columns) == sorted(big_table.columns)
+    for column in big_table.columns:
+        assert (
+            star_table[column].astype(object).equals(big_table[column].astype(object))
+        ), f"Column {column} differs from the big table"
+
+
+def test_read_star_schema_columns(tmp_path, etl_data_frames):
+    write_star_schema(build_star_schema(etl_data_frames), str(tmp_path))
+    table = read_star_schema(str(tmp_path), ["price", "english_category_name"])
+    assert list(table.columns) == ["price", "english_category_name"]
+    assert table["english_category_name"].astype(object).tolist()[:3] == [
+        "books",
+        "toys",
+        "books",
+    ]
+    with pytest.raises(ValueError):
+        read_star_schema(str(tmp_path), ["not_a_column"])
+    with pytest.raises(ValueError, match="join keys"):
+        read_star_schema(str(tmp_path), ["price", "product_key"])
 
 
 if __name__ == "__main__":
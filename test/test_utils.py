@@ -1,4 +1,6 @@
+import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 import pytest
 
 from main.utils import (
@@ -6,6 +8,10 @@ from main.utils import (
     categorize_columns,
     columns_to_datetime,
     column_dropper,
+    parquet_write_options,
+    get_path_size,
+    aggregate_on_key,
+    join_positions,
 )
 
 
@@ -90,5 +96,111 @@ def test_column_dropper(sample_data):
     assert "places" not in data3.columns
 
 
+def test_parquet_write_options():
+    profile = {
+        "compression": "zstd",
+        "compression_level": 9,
+        "use_dictionary": ["city", "missing"],
+        "use_byte_stream_split": False,
+        "index": False,
+    }
+    options = parquet_write_options(profile, ["name", "city"])
+    assert options["use_dictionary"] == ["city"]
+    assert options["compression_level"] == 9
+    assert options["use_byte_stream_split"] is False
+    assert profile["use_dictionary"] == ["city", "missing"], "Profile was modified"
+    assert parquet_write_options(None) == {}
+
+
+def test_parquet_write_options_encodings(tmp_path):
+    data = pd.DataFrame(
+        {"city": ["Sao Paulo", "Curitiba"] * 50, "price": [1.5, 2.25] * 50}
+    )
+    profile = {
+        "compression": "zstd",
+        "use_dictionary": True,
+        "use_byte_stream_split": ["price"],
+        "index": False,
+    }
+    options = parquet_write_options(profile, data.columns)
+    assert options["use_dictionary"] == ["city"]
+    data.to_parquet(tmp_path / "test.parquet", **options)
+    row_group = pq.read_metadata(tmp_path / "test.parquet").row_group(0)
+    encodings = {
+        row_group.column(i).path_in_schema: row_group.column(i).encodings
+        for i in range(row_group.num_columns)
+    }
+    assert "BYTE_STREAM_SPLIT" in encodings["price"]
+    assert "RLE_DICTIONARY" not in encodings["price"]
+    assert "RLE_DICTIONARY" in encodings["city"]
+    with pytest.raises(ValueError):
+        parquet_write_options(profile)
+
+
+def test_parquet_write_options_invalid():
+    with pytest.raises(ValueError):
+        parquet_write_options({"compression": "brotli"})
+    with pytest.raises(ValueError):
+        parquet_write_options({"compression": "snappy", "compression_level": 3})
+
+
+def test_get_path_size(tmp_path):
+    (tmp_path / "part").mkdir()
+    (tmp_path / "part" / "a.parquet").write_bytes(b"12345")
+    (tmp_path / "b.parquet").write_bytes(b"123")
+    assert get_path_size(tmp_path / "b.parquet") == 3
+    assert get_path_size(tmp_path) == 8
+
+
+def test_aggregate_on_key():
+    items = pd.DataFrame(
+        {
+            "order_id": ["o3", "o1", "o3", "o2", "o1"],
+            "price": [1.0, 2.0, None, 4.0, 5.0],
+            "order_item_id": [1, 1, 2, 1, 2],
+        }
+    )
+    reviews = pd.DataFrame(
+        {"order_id": ["o1", "o3", "o3", "o4"], "review_score": [5, 4, 1, 3]}
+    )
+    result = aggregate_on_key(
+        "order_id",
+        (items, {"total": ("price", "sum"), "items": ("order_item_id", "max")}),
+        (reviews, {"review_score": ("review_score", "mean")}),
+    )
+    expected = pd.merge(
+        items.groupby("order_id").agg(
+            total=("price", "sum"), items=("order_item_id", "max")
+        ),
+        reviews.groupby("order_id").agg({"review_score": "mean"}),
+        on="order_id",
+    )
+    assert list(result.index) == ["o1", "o3"], "Only keys present in every table"
+    assert (
+        result.reset_index()
+        .astype(object)
+        .equals(expected.reset_index().astype(object))
+    )
+
+
+def test_join_positions():
+    left = np.array([1, -1, 0, 1])
+    right = np.array([1, 0, 1, 2, -1])
+    left_rows, right_rows = join_positions(left, right, 3)
+    expected = pd.merge(
+        pd.DataFrame({"key": left, "left_row": range(4)}).query("key >= 0"),
+        pd.DataFrame({"key": right, "right_row": range(5)}).query("key >= 0"),
+        on="key",
+    ).sort_values(["key", "left_row", "right_row"])
+    assert left_rows.tolist() == expected["left_row"].tolist()
+    assert right_rows.tolist() == expected["right_row"].tolist()
+
+
+def test_aggregate_on_key_invalid_function():
+    data = pd.DataFrame({"order_id": ["o1"], "price": [1.0]})
+    with pytest.raises(ValueError):
+        aggregate_on_key("order_id", (data, {"price": ("price", "median")}))
+
+
 if __name__ == "__main__":
     pytest.main()